@@ -1,5 +1,10 @@
+import functools
+import mmap
+import os
+import re
+import stat
 import sys
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import config
 
 if config.language == "c++":
@@ -13,6 +18,7 @@ if config.language == "c++":
         clang.cindex.Config.set_library_file("C:/Program Files/LLVM/bin/libclang.dll")
 elif config.language == "python":
     import ast
+    from collections import deque
 
 MAX_HEIGHT_IN = 8.5
 MAX_WIDTH_IN = 7
@@ -24,116 +30,221 @@ LINE_SPACE_SCALE = 2  # double space
 RED = '\033[91m'
 END = '\033[0m'
 
+# placeholders in the template, all substituted in a single pass
+PLACEHOLDERS = re.compile(
+    "REPLACEWITHLANGUGE|REPLACEWITHTITLE|REPLACEWITHCODE|FONTSIZE|SKIPSIZE"
+)
+
+# characters the listings package can't handle
+NON_LATIN1 = re.compile("[^\x00-\xff]")
+
 
 def unindent(snippet: list[str]) -> None:
     """
     Remove any consistent indentation from all lines
     """
-    while all(len(line) > 0 and line[0] == " " for line in snippet):
-        for i in range(len(snippet)):
-            snippet[i] = snippet[i][1:]
+    indent = min(
+        (len(line) - len(line.lstrip(" ")) for line in snippet if line.strip()),
+        default=0,
+    )
+    if indent:
+        snippet[:] = [line[indent:] for line in snippet]
 
 
-def clang_find_helper_calls(node: object, helpers: set[str]):
+def clang_find_helper_calls(node: object, helpers: dict[str, None]):
+    """
+    Visit the nodes below the given one and find all function calls.
+    """
+    CALL = clang.cindex.CursorKind.CALL_EXPR
+    stack = list(node.get_children())
+    push = stack.extend
+    pop = stack.pop
+    while stack:
+        child = pop()
+        if child.kind == CALL:
+            helpers[child.spelling] = None
+        push(child.get_children())
+
+
+def clang_index_functions(tu_cursor: object) -> dict[str, tuple[int, int, dict]]:
     """
-    Recursively visit the nodes and find all function calls.
+    Walk the clang-parsed AST once and build a table of function definitions,
+    mapping each name to its (start, end) offsets and the functions it calls.
     """
-    for child in node.get_children():
-        if child.kind == clang.cindex.CursorKind.CALL_EXPR:
-            helpers.add(child.spelling)
-        clang_find_helper_calls(child, helpers)
+    kinds = clang.cindex.CursorKind
+    FUNC = kinds.FUNCTION_DECL
+    # functions can't be defined inside any of these, so no need to look inside
+    BODIES = {
+        FUNC,
+        kinds.CXX_METHOD,
+        kinds.CONSTRUCTOR,
+        kinds.DESTRUCTOR,
+        kinds.CONVERSION_FUNCTION,
+        kinds.FUNCTION_TEMPLATE,
+    }
+    table = {}
+    # only the declarations in the file itself are of interest, so skip
+    # everything pulled in by #include (usually the bulk of the AST)
+    main_file = tu_cursor.spelling
+    # explicit stack instead of recursion, children reversed to keep preorder
+    stack = [
+        child
+        for child in reversed(list(tu_cursor.get_children()))
+        if child.location.file and child.location.file.name == main_file
+    ]
+    push = stack.extend
+    pop = stack.pop
+    while stack:
+        node = pop()
+        kind = node.kind
+        if kind not in BODIES:
+            push(reversed(list(node.get_children())))
+        elif (
+            kind == FUNC
+            and node.is_definition()
+            and node.spelling not in table
+        ):
+            calls = {}
+            clang_find_helper_calls(node, calls)
+            table[node.spelling] = (
+                node.extent.start.offset,
+                node.extent.end.offset,
+                calls,
+            )
+
+    return table
+
+
+@functools.cache
+def clang_index() -> object:
+    """
+    Creates the clang index shared by every file parsed in this process.
+    """
+    return clang.cindex.Index.create()
 
 
-def clang_find_function(
-    node: object, func_name: str, helpers: set[str], processed: set[str]
-) -> tuple[None, None]:
+@functools.lru_cache(maxsize=128)
+def parse_cpp(fname: str, content: str) -> dict[str, tuple[int, int, dict]]:
     """
-    Recursively visit the nodes of the clang-parsed AST.
+    Parse the given C++ file and index its function definitions.
+    Cached on the file name and contents, so a file repeated within a worker
+    process is only parsed once. Only the table is kept, so the translation
+    unit is freed once it has been indexed.
     """
-    bounds = None
-    if (
-        node.kind == clang.cindex.CursorKind.FUNCTION_DECL
-        and node.spelling == func_name
-        and node.is_definition()
-    ):
-        # update the start/end bounds
-        bounds = (node.extent.start.offset, node.extent.end.offset)
-        processed.add(func_name)
-        clang_find_helper_calls(node, helpers)
-    else:
-        # keep looking
-        for child in node.get_children():
-            bounds = clang_find_function(child, func_name, helpers, processed)
-            if bounds:
-                break
-
-    return bounds
+    # Get the "translation unit" resulting from parsing the file, handing
+    # clang the contents we already have rather than having it read the file
+    tu = clang_index().parse(fname, args=["-std=c++17"], unsaved_files=[(fname, content)])
+    return clang_index_functions(tu.cursor)
 
 
 def get_cpp_func(content: str, fname: str, func_name: str) -> str:
     """
     Parse the given C++ file using clang to find the named function body.
     """
+    table = parse_cpp(fname, content)
+    # clang's offsets count bytes, so slice the encoded contents
+    data = content.encode("utf-8")
 
-    index = clang.cindex.Index.create()
-    # Get the "translation unit" resulting from parsing the file
-    # redundant read of the file, but that's what clang wants
-    tu = index.parse(fname, args=["-std=c++17"])
-
-    # then recursively visit and search for the function
-    helpers = set()
-    processed = config.ignore_helpers
+    # then look up the function and any helpers it calls
+    # dict rather than set so helpers come out in a repeatable order
+    helpers = {}
+    # copy, so the config isn't modified between calls
+    processed = set(config.ignore_helpers)
 
     snippet = ""
-    if bounds := clang_find_function(tu.cursor, func_name, helpers, processed):
-        snippet = content[bounds[0] : bounds[1]]
+    if found := table.get(func_name):
+        start, end, calls = found
+        snippet = data[start:end].decode("utf-8")
+        processed.add(func_name)
+        helpers.update(calls)
 
     # check for helper functions as well
     while helpers:
-        helper = helpers.pop()
+        helper, _ = helpers.popitem()
         if helper not in processed:
-            bounds = clang_find_function(tu.cursor, helper, helpers, processed)
-            if bounds:
-                snippet += "\n\n" + content[bounds[0] : bounds[1]]
+            if found := table.get(helper):
+                start, end, calls = found
+                snippet += "\n\n" + data[start:end].decode("utf-8")
+                helpers.update(calls)
             processed.add(helper)
 
     return snippet
 
 
-def get_python_func(
-    content: str, func_name: str, helpers: set[str], processed: set[str]
-) -> str:
+@functools.lru_cache(maxsize=128)
+def parse_python(content: str) -> tuple[bytes, dict]:
     """
-    Parse the given Python code using ast to find the named function body.
+    Parse the given Python code and index its function definitions,
+    mapping each name to the (start, end) offsets and node of every
+    function defined with it. Offsets index into the returned UTF-8 bytes.
+    Cached on the contents so repeated code is only parsed once.
     """
     tree = ast.parse(content)
-    snippet = ""
-    for node in ast.walk(tree):
-        if isinstance(node, ast.FunctionDef) and node.name == func_name:
+    # ast column offsets count bytes, so work out where each line starts
+    # in the encoded contents once rather than per segment
+    data = content.encode("utf-8")
+    line_starts = [0]
+    i = data.find(b"\n")
+    while i >= 0:
+        line_starts.append(i + 1)
+        i = data.find(b"\n", i + 1)
+
+    # only look at top-level functions and class methods, not the whole tree.
+    # Nested functions are already part of their parent's snippet.
+    defs = tree.body + [
+        member
+        for node in tree.body
+        if type(node) is ast.ClassDef
+        for member in node.body
+    ]
+    table = {}
+    for node in defs:
+        if type(node) is ast.FunctionDef:
+            table.setdefault(node.name, []).append((
+                line_starts[node.lineno - 1] + node.col_offset,
+                line_starts[node.end_lineno - 1] + node.end_col_offset,
+                node,
+            ))
+
+    return data, table
+
+
+def get_python_func(content: str, func_name: str) -> str:
+    """
+    Parse the given Python code using ast to find the named function body.
+    """
+    data, table = parse_python(content)
+    # copy, so the config isn't modified between calls
+    processed = set(config.ignore_helpers)
+    processed.add(func_name)
+
+    # work through the function and then the helpers it calls, breadth-first
+    snippets = []
+    todo = deque([func_name])
+    while todo:
+        for start, end, node in table.get(todo.popleft(), []):
             # add the function body to the snippet
-            snippet += ast.get_source_segment(content, node).strip()
-            processed.add(node.name)
-
-            # check for helper functions and add to the set
-            for child in ast.walk(node):
-                if isinstance(child, ast.Call):
+            snippets.append(data[start:end].decode("utf-8").strip())
+
+            # check for helper functions and add to the worklist
+            stack = [node]
+            push = stack.extend
+            pop = stack.pop
+            while stack:
+                child = pop()
+                push(ast.iter_child_nodes(child))
+                if type(child) is ast.Call:
                     # for some reason function calls can be either ast.Name or ast.Attr
                     name = (
                         child.func.id
-                        if isinstance(child.func, ast.Name)
+                        if type(child.func) is ast.Name
                         else child.func.attr
                     )
-                    helpers.add(name)
-
-            while helpers:
-                helper = helpers.pop()
-                if helper not in processed:
-                    # recursively call self
-                    snippet += "\n" + get_python_func(
-                        content, helper, helpers, processed
-                    )
+                    if name not in processed:
+                        processed.add(name)
+                        todo.append(name)
 
-    return snippet
+    return "\n".join(snippets)
 
 
 def strip_unicode(src: str) -> str|None:
@@ -141,52 +252,45 @@ def strip_unicode(src: str) -> str|None:
     Checks for non-ascii unicode characters. Prints out a warning if found,
     and returns a copy with offending chars replaced with spaces, or None.
     """
-    non_ascii_c = []
-    for line in src.splitlines():
-        non_ascii_i = []
-        for i, c in enumerate(line):
-            if ord(c) > 255:
-                non_ascii_c.append(c)
-                non_ascii_i.append(i)
-        
-        if non_ascii_i:
-            for i in range(len(line)):
-                if i in non_ascii_i:
-                    print(RED + line[i] + END, end="")
-                else:
-                    print(line[i], end="")
-    
-    if non_ascii_c:
-        print(RED + "\nNon-ascii characters found!" + END)
-        for c in set(non_ascii_c):
-            src = src.replace(c, ' ')
-        return src
-    else:
+    # let the regex engine do the scanning rather than checking every char
+    if not NON_LATIN1.search(src):
         return None
 
+    for line in src.splitlines():
+        if NON_LATIN1.search(line):
+            print(NON_LATIN1.sub(lambda m: RED + m.group(0) + END, line), end="")
+
+    print(RED + "\nNon-ascii characters found!" + END)
+    return NON_LATIN1.sub(" ", src)
+
 
 def find_snippet(fname: str) -> list[str]:
     """
-    Finds the code snippet defined by config.regex.
+    Finds the code snippet for config.function_name and any helpers it calls.
     """
-    with open(fname, "r", encoding="utf-8") as f:
-        content = f.read()
-    
+    with open(fname, "rb") as f:
+        st = os.fstat(f.fileno())
+        if stat.S_ISREG(st.st_mode) and st.st_size:
+            # decode straight from the mapped file, skipping the bytes copy
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                content = str(mm, "utf-8")
+        else:
+            # empty files, pipes etc. can't be mapped
+            content = f.read().decode("utf-8")
+
+    # match the universal newlines of a text-mode read
+    if "\r" in content:
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
+
     if new_contents := strip_unicode(content):
-        # found some funky chars, write a new copy without them
-        print("Writing temp copy of", fname, "with Unicode chars removed")
-        fname = "temp.cpp"
+        # found some funky chars, carry on with a copy without them.
+        # Clang is given the contents directly, so no temp file is needed.
         content = new_contents
-        # Clang assumes unix-style line endings regardless of platform
-        with open(fname, "w", newline='\n') as f:
-            f.write(new_contents)
 
     if config.language == "c++":
         snippet = get_cpp_func(content, fname, config.function_name)
     elif config.language == "python":
-        helpers = set()
-        processed = config.ignore_helpers
-        snippet = get_python_func(content, config.function_name, helpers, processed)
+        snippet = get_python_func(content, config.function_name)
     else:
         print("Sorry, only C++ and Python supported at this time")
         sys.exit(1)
@@ -205,46 +309,63 @@ def calc_fontsize(code: list[str]) -> float:
     Calculate the font size needed to fit the code on one page.
     """
     h_min = MAX_HEIGHT_IN * PT_PER_INCH / (len(code) * LINE_SPACE_SCALE)
-    longest_line = max([len(line) for line in code])
+    longest_line = max(map(len, code))
     # print(f"Longest line: {longest_line} characters")
     w_min = MAX_WIDTH_IN * PT_PER_INCH / (longest_line * BOX_WIDTH_EM)
     return min(h_min, w_min)
 
 
+@functools.cache
+def read_template() -> str:
+    """
+    Reads the template file, only once per run.
+    """
+    with open(config.template, "r", encoding="utf-8") as f:
+        return f.read()
+
+
 def write_tex(fname: str, code: list[str], fontsize: float) -> None:
     """
     Modifies the template file and writes to output directory.
     """
-    with open(config.template, "r") as f:
-        text = f.read()
+    text = read_template()
 
     # Assumes the files are in folders named for each student
-    if not (student_name := Path(fname).parent.name):
-        student_name = Path(fname).name
+    fname = os.path.normpath(fname)
+    if not (student_name := os.path.basename(os.path.dirname(fname))):
+        student_name = os.path.basename(fname)
 
     student_name = student_name.replace("_", "")
 
     # replace placeholders
-    text = text.replace("REPLACEWITHLANGUGE", config.language)
-    text = text.replace("REPLACEWITHTITLE", config.title_prefix + ": " + student_name)
-    text = text.replace("REPLACEWITHCODE", "\n".join(code))
-    text = text.replace("FONTSIZE", f"{fontsize:.1f}")
-    text = text.replace("SKIPSIZE", f"{fontsize * LINE_SPACE_SCALE:.1f}")
+    repl = {
+        "REPLACEWITHLANGUGE": config.language,
+        "REPLACEWITHTITLE": config.title_prefix + ": " + student_name,
+        "REPLACEWITHCODE": "\n".join(code),
+        "FONTSIZE": f"{fontsize:.1f}",
+        "SKIPSIZE": f"{fontsize * LINE_SPACE_SCALE:.1f}",
+    }
+    text = PLACEHOLDERS.sub(lambda m: repl[m.group(0)], text)
 
-    with open(config.output_dir / (student_name + ".tex"), "w") as f:
-        f.write(text)
+    (config.output_dir / (student_name + ".tex")).write_bytes(text.encode("utf-8"))
 
 
 def main(files: list[str]) -> None:
     """
-    Loop over the given files, find the matching regex in the code, output to pdf.
+    Loop over the given files, find the named function in the code, output to pdf.
     """
     config.output_dir.mkdir(parents=True, exist_ok=True)
 
-    for fname in files:
-        if code := find_snippet(fname):
-            fontsize = calc_fontsize(code)
-            write_tex(fname, code, fontsize)
+    if not files:
+        return
+
+    # each file is independent, so parse them in parallel, writing each
+    # result as it arrives so a failing file doesn't lose the ones before it
+    with ProcessPoolExecutor(max_workers=min(len(files), os.cpu_count() or 1)) as ex:
+        for fname, code in zip(files, ex.map(find_snippet, files)):
+            if code:
+                fontsize = calc_fontsize(code)
+                write_tex(fname, code, fontsize)
 
 
 if __name__ == "__main__":
@@ -5,4 +5,4 @@ template = "templates/one_page.tex"
 title_prefix = "COMP 1633 A1 Quiz"
 function_name = r"evolve"
 language = "c++" # python or c++, case-sensitive
-ignore_helpers = set([]) # which helper functions to ignore?
\ No newline at end of file
+ignore_helpers = frozenset([]) # which helper functions to ignore?
\ No newline at end of file